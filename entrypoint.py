@@ -2,15 +2,19 @@
 
 import os
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from json import loads as load_json
+from heapq import heapify, heappop
 from os import environ, makedirs
 from os.path import dirname, isfile
-from subprocess import PIPE, run
-from threading import Thread
-from time import sleep
+from queue import Empty, Full, Queue
+from subprocess import PIPE, Popen, run
+from threading import Event, Lock, Thread
+from time import monotonic, sleep, time
+from traceback import print_exc
 from typing import Optional
 
+from orjson import loads as load_json
 from plex_refresh import scan_paths as scan_plex
 
 RCLONE_CONF = '/config/rclone/rclone.conf'
@@ -23,6 +27,14 @@ EXTRA_FLAGS = EXTRA_FLAGS.split(',') if EXTRA_FLAGS else []
 MAX_PATH_LENGTH = environ.get('MAX_PATH_LENGTH', None)
 MAX_PATH_LENGTH = int(MAX_PATH_LENGTH) if MAX_PATH_LENGTH else None
 PLEX_PREFIX = environ.get('PLEX_PREFIX', None)
+# with -L/--copy-links rclone uploads symlink targets, so those need watching too
+FOLLOW_LINKS = any(f == '-L' or f.startswith('--copy-links') for f in EXTRA_FLAGS) \
+    or environ.get('RCLONE_COPY_LINKS', '').lower() in ('1', 'true')
+# every rclone process applies --tpslimit on its own, so parallel evictions multiply it
+EVICT_WORKERS = environ.get('RCLONE_EVICT_WORKERS', None)
+TPS_LIMITED = environ.get('RCLONE_TPSLIMIT', '0') not in ('', '0') \
+    or any(f.startswith('--tpslimit') for f in EXTRA_FLAGS)
+EVICT_WORKERS = max(1, int(EVICT_WORKERS)) if EVICT_WORKERS else (1 if TPS_LIMITED else 8)
 
 if not SOURCE or not DEST:
     raise ValueError('SOURCE and DEST must be set')
@@ -37,22 +49,60 @@ def rclone_ls():
         '--recursive', 
         '--files-only',
         '--no-mimetype',
+        '--fast-list',
         '--tpslimit', '4',
         *EXTRA_FLAGS,
         DEST
     ]
-    result = run(args, stdout=PIPE, text=True)
-    return load_json(result.stdout)
+    # read the raw bytes straight into the parser, skipping a decoded str copy
+    with Popen(args, stdout=PIPE) as p:
+        listing = p.stdout.read()
+    return load_json(listing)
 
 
-def rclone_delete(path: str):
-    args = ['rclone', 'delete', *EXTRA_FLAGS, f'{DEST}/{path}']
-    run(args, check=True)
+# shared by both cleanup passes; dropped whenever we change the destination ourselves.
+# the lock only guards the bookkeeping, never the listing itself, so invalidating
+# (e.g. after a move on the main thread) doesn't wait on a slow lsjson
+dest_listing_lock = Lock()
+dest_listing: Optional[tuple[float, list]] = None
+dest_listing_generation = 0
+
+def get_dest_listing(ttl: float = 60) -> list:
+    global dest_listing
+    with dest_listing_lock:
+        if dest_listing and monotonic() - dest_listing[0] < ttl:
+            return dest_listing[1]
+        generation = dest_listing_generation
+
+    fetched_at = monotonic()
+    files = rclone_ls()
+
+    with dest_listing_lock:
+        # don't cache a listing that may predate a change we made while it ran
+        if generation == dest_listing_generation:
+            dest_listing = (fetched_at, files)
+    return files
+
+
+def invalidate_dest_listing():
+    global dest_listing, dest_listing_generation
+    with dest_listing_lock:
+        dest_listing = None
+        dest_listing_generation += 1
+
+
+def rclone_delete(paths: list[str]):
+    args = ['rclone', 'delete', *EXTRA_FLAGS, '--files-from-raw', '-', DEST]
+    run(args, input='\n'.join(paths).encode(), check=True)
+    invalidate_dest_listing()
 
 
 def rclone_move(source: str, dest: str):
     args = ['rclone', 'move', *EXTRA_FLAGS, '--progress', '--delete-empty-src-dirs', source, dest]
-    run(args, check=True)
+    try:
+        run(args, check=True)
+    finally:
+        invalidate_dest_listing()
 
 
 def rclone_touch(path: str):
@@ -60,65 +110,151 @@ def rclone_touch(path: str):
     run(args, check=True)
 
 
-def rclone_rcat(contents: str, dest: str):
+def rclone_rcat(contents: bytes, dest: str):
     args = ['rclone', 'rcat', *EXTRA_FLAGS, dest]
     run(args, input=contents, check=True)
 
 
 def truncate_names(dir: str):
-    if not MAX_PATH_LENGTH:
+    max_len = MAX_PATH_LENGTH
+    if not max_len:
         return
 
-    for f in os.scandir(dir):
-        if f.is_dir():
-            truncate_names(f.path)
-        else:
-            if len(f.path) > int(MAX_PATH_LENGTH):
-                path, ext = os.path.splitext(f.path)
-                length = int(MAX_PATH_LENGTH) - len(ext) - 1
+    join, splitext, rename = os.path.join, os.path.splitext, os.rename
+    for root, _, files in os.walk(dir, followlinks=FOLLOW_LINKS):
+        # no name here can push the path over the limit (names are at most 255 bytes)
+        if max_len - len(root) - 1 >= 255:
+            continue
+
+        for name in files:
+            full = join(root, name)
+            if len(full) > max_len:
+                path, ext = splitext(full)
+                length = max_len - len(ext) - 1
                 new_path = f'{path[:length]}{ext}'
-                print(f"Truncating {f.path} to {new_path}")
-                os.rename(f.path, new_path)
+                print(f"Truncating {full} to {new_path}")
+                rename(full, new_path)
+
+
+def _cleanup():
+    size_limit = environ.get('RCLONE_SIZE_LIMIT')
+    if not size_limit:
+        return
+
+    size_limit = int(size_limit)
 
-cleanup_thread: Optional[Thread] = None
+    files = get_dest_listing()
+    usage = sum(f['Size'] for f in files)
+    by_age = [(f['ModTime'], f['Path'], f['Size']) for f in files]
+    heapify(by_age)
+    victims = []
+    while by_age and usage >= size_limit:
+        _, path, size = heappop(by_age)
+        victims.append(path)
+        usage -= size
+
+    if not victims:
+        return
+
+    print(f"Destination usage is over {size_limit}, cleaning up {len(victims)} files")
+
+    emptied, error = [], None
+
+    def _empty(path: str):
+        print(f"Deleting {path}")
+        rclone_rcat(b'', f"{DEST}/{path}")
+        # truncated now, so it must be deleted even if the touch below fails
+        emptied.append(path)
+        rclone_touch(f"{DEST}/{path}")
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(EVICT_WORKERS, len(victims))) as pool:
+            for future in [pool.submit(_empty, path) for path in victims]:
+                try:
+                    future.result()
+                except Exception as e:
+                    error = error or e
+
+        # delete whatever was emptied, even if some files failed, so none are left as empty stubs
+        if emptied:
+            rclone_delete(emptied)
+    finally:
+        # rcat/touch have changed the destination even if nothing was deleted
+        invalidate_dest_listing()
+
+    if error:
+        raise error
+
+
+# a single long-lived worker runs cleanups; at most one more can be queued behind it
+cleanup_queue: Queue = Queue(maxsize=1)
+cleanup_busy = Event()
+
+def _cleanup_worker():
+    while cleanup_queue.get() is not None:
+        cleanup_busy.set()
+        try:
+            _cleanup()
+        except Exception:
+            print_exc()
+        finally:
+            cleanup_busy.clear()
+
+
+cleanup_thread = Thread(target=_cleanup_worker)
+cleanup_thread.start()
 
 def cleanup():
-    def _cleanup():
-        size_limit = environ.get('RCLONE_SIZE_LIMIT')
-        if not size_limit:
-            return
-
-        size_limit = int(size_limit)
-
-        files: list = rclone_ls()
-        while True:
-            usage = sum(f['Size'] for f in files)
-            if usage < size_limit:
-                break
-
-            print(f"Destination usage is {usage}, which is greater than {size_limit}, cleaning up")
-            
-            oldest = min(files, key=lambda f: f['ModTime'])
-            print(f"Deleting {oldest['Path']}")
-            rclone_rcat('', f"{DEST}/{oldest['Path']}")
-            rclone_touch(f"{DEST}/{oldest['Path']}")
-            rclone_delete(oldest['Path'])
-            files.remove(oldest)
-
-    global cleanup_thread
-    if cleanup_thread and cleanup_thread.is_alive():
-        print('Cleanup already running')
+    try:
+        cleanup_queue.put_nowait(True)
+    except Full:
+        print('Cleanup already pending')
+
+
+# path -> (mtime_ns, subdirs, files); a directory's mtime only moves when entries
+# are added, removed or renamed, so its listing can be reused until then
+dir_listings: dict[str, tuple[int, list[str], list[str]]] = {}
+
+def list_dir(dir: str) -> tuple[list[str], list[str]]:
+    st = os.stat(dir)
+    cached = dir_listings.get(dir)
+    if cached and cached[0] == st.st_mtime_ns:
+        return cached[1], cached[2]
+
+    subdirs, files = [], []
+    with os.scandir(dir) as entries:
+        # keep files in inode order so get_file_sizes stats them near-sequentially;
+        # inode() and is_dir() are answered from the readdir buffer (bar followed symlinks)
+        for f in sorted(entries, key=lambda e: e.inode()):
+            if f.is_dir(follow_symlinks=FOLLOW_LINKS):
+                subdirs.append(f.path)
+            else:
+                files.append(f.path)
+
+    # a directory modified within the last second could change again without its mtime moving
+    if time() - st.st_mtime > 1:
+        dir_listings[dir] = (st.st_mtime_ns, subdirs, files)
     else:
-        cleanup_thread = Thread(target=_cleanup)
-        cleanup_thread.start()
+        # drop the old listing too, or restoring the old mtime (tar, rsync -t) would revive it
+        dir_listings.pop(dir, None)
+    return subdirs, files
 
 
 def get_file_sizes(dir: str):
-    for f in os.scandir(dir):
-        if f.is_dir():
-            yield from get_file_sizes(f.path)
-        else:
-            yield (os.path.join(dir, f.name), f.stat().st_size)
+    seen = set()
+    dirs = [dir]
+    while dirs:
+        d = dirs.pop()
+        seen.add(d)
+        subdirs, files = list_dir(d)
+        dirs.extend(subdirs)
+        for path in files:
+            # one stat per file, in the inode order list_dir kept; sizes can't be cached
+            # because appending to a file doesn't touch its directory's mtime
+            yield (path, os.stat(path, follow_symlinks=FOLLOW_LINKS).st_size)
+
+    for d in dir_listings.keys() - seen:
+        del dir_listings[d]
 
 
 def refresh_plex(paths: list[str]):
@@ -138,15 +274,12 @@ try:
         if glob(f'{SOURCE}/*'):
 
             # wait for files to stop changing
-            file_paths = []
-            files = ""
+            file_sizes = None
             while True:
                 print("Waiting for files to stop changing...")
-                file_sizes = list(get_file_sizes(SOURCE))
-                new_files = ','.join(f'{f} {s}' for f, s in file_sizes)
-                file_paths = [f for f, _ in file_sizes]
-                if files != new_files:
-                    files = new_files
+                new_file_sizes = dict(get_file_sizes(SOURCE))
+                if new_file_sizes != file_sizes:
+                    file_sizes = new_file_sizes
                     sleep(5)
                 else:
                     break
@@ -156,14 +289,21 @@ try:
             truncate_names(SOURCE)
             rclone_move(SOURCE, DEST)
 
-            dirs = list(set(dirname(f) for f in file_paths))
+            dirs = list({f.rsplit('/', 1)[0] for f in file_sizes})
             refresh_plex(dirs)
 
             cleanup()
         else:
             sleep(60)
-except Exception:
-    if cleanup_thread and cleanup_thread.is_alive():
-        print('Error during move, waiting for cleanup to finish before exiting')
-        cleanup_thread.join()
-    raise
+finally:
+    # let an in-flight cleanup finish on every exit path, including Ctrl-C/SystemExit, so
+    # an eviction is never cut off between emptying files and deleting them; one that is
+    # only queued hasn't touched anything yet, so drop it rather than run a new pass
+    try:
+        cleanup_queue.get_nowait()
+    except Empty:
+        pass
+    if cleanup_busy.is_set():
+        print('Waiting for cleanup to finish before exiting')
+    cleanup_queue.put(None)
+    cleanup_thread.join()